@@ -1,22 +1,134 @@
 import logging
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from multiprocessing.pool import AsyncResult
 from pathlib import Path
 from typing import Annotated
 
 import typer
 
 from yohane import Yohane
+from yohane.corpus import CorpusIndex, build_corpus_index
+from yohane.fingerprint import FingerprintIndex
+from yohane.lyrics import RichText
+from yohane.memory import peak_memory
+from yohane.preflight import PreflightError
+from yohane.resources import (
+    ResourceConfig,
+    StageThreads,
+    available_cpus,
+    benchmark_split,
+    candidate_splits,
+    recommend_split,
+    share_cpus,
+)
+from yohane.workers import YohanePool
 from yohane_cli.audio import (
     SeparatorChoice,
     get_separator,
     parse_song_argument,
+    prefetch_songs,
     save_separated_tracks,
 )
-from yohane_cli.lyrics import parse_lyrics_argument
+from yohane_cli.lyrics import load_lyrics, parse_lyrics_argument
+from yohane_cli.watch import FolderWatcher, WatchJob
 
 logger = logging.getLogger(__name__)
 
 app = typer.Typer()
 
+SeparatorOption = Annotated[
+    SeparatorChoice,
+    typer.Option(
+        "--separator",
+        "-s",
+        help="Source separator to use. 'none' to disable.",
+    ),
+]
+
+AudioOnlyOption = Annotated[
+    bool,
+    typer.Option(
+        "--audio-only",
+        help="Only download the best audio stream when calling yt-dlp.",
+    ),
+]
+
+StreamOption = Annotated[
+    bool,
+    typer.Option(
+        "--stream",
+        help="Compute the alignment emission while the vocals are being separated.",
+    ),
+]
+
+MaxMemoryOption = Annotated[
+    int | None,
+    typer.Option(
+        "--max-memory",
+        help="Memory budget in MiB. Downmixes early and spills waveforms to disk.",
+        min=1,
+    ),
+]
+
+FingerprintIndexOption = Annotated[
+    Path | None,
+    typer.Option(
+        help="Folder of the fingerprint index used to reuse the work done on other versions of the same recordings.",
+        file_okay=False,
+    ),
+]
+
+SeparationThreadsOption = Annotated[
+    int | None,
+    typer.Option(help="Intra-op threads for the vocals separation.", min=1),
+]
+
+EmissionThreadsOption = Annotated[
+    int | None,
+    typer.Option(help="Intra-op threads for the alignment model.", min=1),
+]
+
+AlignmentThreadsOption = Annotated[
+    int | None,
+    typer.Option(help="Intra-op threads for the forced alignment.", min=1),
+]
+
+InteropThreadsOption = Annotated[
+    int | None,
+    typer.Option(help="Inter-op threads of each process.", min=1),
+]
+
+PreflightMinScoreOption = Annotated[
+    float | None,
+    typer.Option(
+        "--preflight-min-score",
+        help="Check that the lyrics roughly fit the song before separating the vocals: minimum mean token probability of a coarse alignment on the mix. Costs a full pass of the alignment model.",
+        min=0.0,
+        max=1.0,
+    ),
+]
+
+PreflightMaxRateOption = Annotated[
+    float | None,
+    typer.Option(
+        "--preflight-max-rate",
+        help="Check that the lyrics roughly fit the song before separating the vocals: maximum transcript tokens per second. Costs a full pass of the alignment model.",
+        min=0.0,
+    ),
+]
+
+LyricsIndexOption = Annotated[
+    Path | None,
+    typer.Option(
+        help="Lyrics index built with 'yohane index'. Lyrics files found in it are not re-parsed.",
+        exists=True,
+        dir_okay=False,
+    ),
+]
+
 
 @app.command(help="Generate a karaoke (full pipeline)")
 def generate(
@@ -32,33 +144,296 @@ def generate(
             help="Text file which contains the lyrics. (Optional: otherwise, a text editor will open.)",
         ),
     ] = None,
-    separator_choice: Annotated[
-        SeparatorChoice,
+    separator_choice: SeparatorOption = SeparatorChoice.VocalRemover,
+    audio_only: AudioOnlyOption = False,
+    stream: StreamOption = False,
+    preflight_min_score: PreflightMinScoreOption = None,
+    preflight_max_rate: PreflightMaxRateOption = None,
+    lyrics_index: LyricsIndexOption = None,
+    fingerprint_index: FingerprintIndexOption = None,
+    max_memory: MaxMemoryOption = None,
+    separation_threads: SeparationThreadsOption = None,
+    emission_threads: EmissionThreadsOption = None,
+    alignment_threads: AlignmentThreadsOption = None,
+    interop_threads: InteropThreadsOption = None,
+):
+    resources = get_resources(
+        separation_threads, emission_threads, alignment_threads, interop_threads
+    )
+    resources.apply()
+    preflight = get_preflight(preflight_min_score, preflight_max_rate)
+
+    song = parse_song_argument(song_file, audio_only=audio_only)
+    index = CorpusIndex.load(lyrics_index) if lyrics_index else None
+    lyrics, tokens = load_lyrics(lyrics_file, index)
+    separator = get_separator(separator_choice)
+
+    fingerprints = FingerprintIndex(fingerprint_index) if fingerprint_index else None
+    yohane = Yohane(separator, max_memory is not None, resources, fingerprints)
+    generate_karaoke(
+        yohane,
+        song,
+        lyrics,
+        tokens,
+        stream=stream,
+        preflight=preflight,
+        max_memory=max_memory,
+    )
+
+
+@app.command(help="Generate karaokes for several songs, downloading ahead")
+def batch(
+    songs_and_lyrics: Annotated[
+        list[str],
+        typer.Argument(
+            help="Pairs of SONG LYRICS_FILE. Songs can be URLs to download with yt-dlp.",
+        ),
+    ],
+    separator_choice: SeparatorOption = SeparatorChoice.VocalRemover,
+    audio_only: AudioOnlyOption = False,
+    prefetch: Annotated[
+        int,
+        typer.Option(
+            help="Number of upcoming songs to download while processing the current one.",
+            min=0,
+        ),
+    ] = 2,
+    workers: Annotated[
+        int,
         typer.Option(
-            "--separator",
-            "-s",
-            help="Source separator to use. 'none' to disable.",
+            help="Number of worker processes sharing the same model weights.",
+            min=1,
         ),
-    ] = SeparatorChoice.VocalRemover,
+    ] = 1,
+    pin: Annotated[
+        bool,
+        typer.Option(help="Pin each worker to its own share of the cpus."),
+    ] = False,
+    stream: StreamOption = False,
+    preflight_min_score: PreflightMinScoreOption = None,
+    preflight_max_rate: PreflightMaxRateOption = None,
+    lyrics_index: LyricsIndexOption = None,
+    fingerprint_index: FingerprintIndexOption = None,
+    max_memory: MaxMemoryOption = None,
+    separation_threads: SeparationThreadsOption = None,
+    emission_threads: EmissionThreadsOption = None,
+    alignment_threads: AlignmentThreadsOption = None,
+    interop_threads: InteropThreadsOption = None,
 ):
-    song = parse_song_argument(song_file)
-    lyrics = parse_lyrics_argument(lyrics_file)
+    if len(songs_and_lyrics) % 2 != 0:
+        raise typer.BadParameter(
+            "expected pairs of SONG LYRICS_FILE", param_hint="'SONGS_AND_LYRICS...'"
+        )
+    song_files = songs_and_lyrics[::2]
+    lyrics_files = [Path(value) for value in songs_and_lyrics[1::2]]
+
+    index = CorpusIndex.load(lyrics_index) if lyrics_index else None
+    fingerprints = FingerprintIndex(fingerprint_index) if fingerprint_index else None
     separator = get_separator(separator_choice)
+    resolve = partial(parse_song_argument, audio_only=audio_only)
+    songs = prefetch_songs(song_files, depth=prefetch, resolve=resolve)
 
-    yohane = Yohane(separator)
+    low_memory = max_memory is not None
+    resources = get_resources(
+        separation_threads, emission_threads, alignment_threads, interop_threads
+    )
+    preflight = get_preflight(preflight_min_score, preflight_max_rate)
 
-    yohane.load_song(song)
-    yohane.load_lyrics(lyrics)
+    if workers == 1:
+        resources.apply()
+        for song, lyrics_file in zip(songs, lyrics_files):
+            lyrics, tokens = load_lyrics(lyrics_file, index)
+            yohane = Yohane(separator, low_memory, resources, fingerprints)
+            try:
+                generate_karaoke(
+                    yohane,
+                    song,
+                    lyrics,
+                    tokens,
+                    stream=stream,
+                    preflight=preflight,
+                    max_memory=max_memory,
+                )
+            except PreflightError as e:
+                logger.error(f"Skipping '{song.name}': {e}")
+        return
 
-    yohane.extract_vocals()
-    save_separated_tracks(yohane, song)
+    def wait(result: AsyncResult[None]):
+        try:
+            result.get()
+        except PreflightError as e:
+            logger.error(f"Skipping a song: {e}")
+
+    with YohanePool(
+        separator, workers, low_memory, resources, pin, fingerprints
+    ) as pool:
+        results = deque()
+        for song, lyrics_file in zip(songs, lyrics_files):
+            if len(results) >= workers:
+                wait(results.popleft())
+            lyrics, tokens = load_lyrics(lyrics_file, index)
+            result = pool.submit(
+                generate_karaoke,
+                song,
+                lyrics,
+                tokens,
+                stream=stream,
+                preflight=preflight,
+                max_memory=max_memory,
+            )
+            results.append(result)
+        for result in results:
+            wait(result)
+
+
+@app.command(help="Watch a folder and generate karaokes for new song/lyrics pairs")
+def watch(
+    directory: Annotated[
+        Path,
+        typer.Argument(
+            help="Folder to watch. Songs are paired with the .txt lyrics file of the same name.",
+            exists=True,
+            file_okay=False,
+        ),
+    ],
+    separator_choice: SeparatorOption = SeparatorChoice.VocalRemover,
+    stream: StreamOption = False,
+    preflight_min_score: PreflightMinScoreOption = None,
+    preflight_max_rate: PreflightMaxRateOption = None,
+    interval: Annotated[
+        float,
+        typer.Option(help="Seconds between two scans of the folder."),
+    ] = 2.0,
+    settle: Annotated[
+        float,
+        typer.Option(help="Seconds a file must stay unchanged before it is used."),
+    ] = 5.0,
+    workers: Annotated[
+        int,
+        typer.Option(help="Number of songs processed concurrently.", min=1),
+    ] = 1,
+    fingerprint_index: FingerprintIndexOption = None,
+    max_memory: MaxMemoryOption = None,
+    separation_threads: SeparationThreadsOption = None,
+    emission_threads: EmissionThreadsOption = None,
+    alignment_threads: AlignmentThreadsOption = None,
+    interop_threads: InteropThreadsOption = None,
+):
+    separator = get_separator(separator_choice)
+    low_memory = max_memory is not None
+    fingerprints = FingerprintIndex(fingerprint_index) if fingerprint_index else None
+    preflight = get_preflight(preflight_min_score, preflight_max_rate)
+    resources = get_resources(
+        separation_threads, emission_threads, alignment_threads, interop_threads
+    )
+    if workers > 1:
+        # thread counts are process-wide: concurrent songs cannot use
+        # different counts per stage, only one for the whole process
+        stage_threads = {separation_threads, emission_threads, alignment_threads}
+        stage_threads.discard(None)
+        if len(stage_threads) > 1:
+            raise typer.BadParameter(
+                "per-stage thread counts must be equal with several workers",
+                param_hint="'--separation-threads/--emission-threads/--alignment-threads'",
+            )
+        resources = ResourceConfig(
+            intra_op=stage_threads.pop() if stage_threads else None,
+            inter_op=interop_threads,
+        )
+    resources.apply()
+    watcher = FolderWatcher(
+        directory,
+        # every option which changes the output files
+        settings={
+            "separator": separator_choice.value,
+            "stream": stream,
+            # low memory mode downmixes the separated tracks
+            "low_memory": low_memory,
+            "fingerprint_index": fingerprint_index and fingerprint_index.as_posix(),
+        },
+        settle=settle,
+    )
 
-    yohane.force_align()
+    def run(job: WatchJob):
+        song = parse_song_argument(job.song.as_posix())
+        lyrics = RichText.parse(parse_lyrics_argument(job.lyrics))
+        yohane = Yohane(separator, low_memory, resources, fingerprints)
+        generate_karaoke(
+            yohane,
+            song,
+            lyrics,
+            stream=stream,
+            preflight=preflight,
+            max_memory=max_memory,
+        )
+
+    logger.info(f"Watching '{directory.as_posix()}'")
+    running: dict[Future[None], WatchJob] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for future in [future for future in running if future.done()]:
+                job = running.pop(future)
+                if (exc := future.exception()) is not None:
+                    logger.error(f"Failed to process '{job.song.name}'", exc_info=exc)
+                    watcher.failed(job)
+                else:
+                    watcher.done(job)
+            # only pick new work when a worker is free, the rest waits on disk
+            if len(running) < workers:
+                for job in watcher.scan(limit=workers - len(running)):
+                    logger.info(f"Queuing '{job.song.name}' with '{job.lyrics.name}'")
+                    running[executor.submit(run, job)] = job
+            time.sleep(interval)
+
+
+@app.command("resources", help="Recommend a workers × threads split for this host")
+def recommend_resources(
+    duration: Annotated[
+        float,
+        typer.Option(help="Duration of the benchmark of each split, in seconds."),
+    ] = 5.0,
+):
+    cpus = available_cpus()
+    typer.echo(f"{len(cpus)} cpus available, benchmarking the alignment model")
 
-    subs = yohane.make_subs()
-    subs_file = song.with_suffix(".ass")
-    subs.save(subs_file.as_posix())
-    logger.info(f"Result saved to '{subs_file.as_posix()}'")
+    results = {}
+    for workers in candidate_splits(len(cpus)):
+        throughput = benchmark_split(workers, duration=duration)
+        results[workers] = throughput
+        threads = format_threads(cpus, workers)
+        typer.echo(
+            f"{workers:>3} workers × {threads:>5} threads: {throughput:.1f}s of audio/s"
+        )
+    workers = recommend_split(results)
+    typer.echo(
+        f"Recommended: {workers} workers × {format_threads(cpus, workers)} threads"
+    )
+
+
+def format_threads(cpus: list[int], workers: int):
+    sizes = sorted({len(cpu_set) for cpu_set in share_cpus(cpus, workers)})
+    return "-".join(map(str, sizes))
+
+
+@app.command("index", help="Preprocess lyrics files into an index for generate/batch")
+def build_index(
+    lyrics_files: Annotated[
+        list[Path],
+        typer.Argument(
+            help="Text files which contain the lyrics.", exists=True, dir_okay=False
+        ),
+    ],
+    output: Annotated[
+        Path,
+        typer.Option("--output", "-o", help="Where to write the index."),
+    ] = Path("lyrics.index"),
+    workers: Annotated[
+        int | None,
+        typer.Option(help="Number of worker processes. Defaults to the cpu count."),
+    ] = None,
+):
+    build_corpus_index(lyrics_files, workers).save(output)
+    logger.info(f"Index saved to '{output.as_posix()}'")
 
 
 @app.command(help="Seperate vocals and instrumental tracks")
@@ -69,16 +444,10 @@ def separate(
             help="Video or audio file of the song. Can be an URL to download with yt-dlp.",
         ),
     ],
-    separator_choice: Annotated[
-        SeparatorChoice,
-        typer.Option(
-            "--separator",
-            "-s",
-            help="Source separator to use. 'none' to disable.",
-        ),
-    ] = SeparatorChoice.VocalRemover,
+    separator_choice: SeparatorOption = SeparatorChoice.VocalRemover,
+    audio_only: AudioOnlyOption = False,
 ):
-    song = parse_song_argument(song_file)
+    song = parse_song_argument(song_file, audio_only=audio_only)
     separator = get_separator(separator_choice)
     if separator is None:
         raise RuntimeError("No separator selected")
@@ -88,3 +457,75 @@ def separate(
 
     yohane.extract_vocals()
     save_separated_tracks(yohane, song)
+
+
+def generate_karaoke(
+    yohane: Yohane,
+    song: Path,
+    lyrics: RichText,
+    tokens: list[list[int]] | None = None,
+    stream: bool = False,
+    preflight: dict[str, float | None] | None = None,
+    max_memory: int | None = None,
+):
+    """
+    `preflight` are the thresholds of the preflight check, which is skipped if
+    None.
+    """
+    with yohane:
+        yohane.load_song(song)
+        yohane.load_lyrics(lyrics, tokens)
+
+        if preflight is not None:
+            yohane.preflight(**preflight)
+
+        if stream:
+            yohane.extract_vocals_and_align()
+            save_separated_tracks(yohane, song)
+        else:
+            yohane.extract_vocals()
+            save_separated_tracks(yohane, song)
+            yohane.force_align()
+
+        subs = yohane.make_subs()
+        subs_file = song.with_suffix(".ass")
+        subs.save(subs_file.as_posix())
+        logger.info(f"Result saved to '{subs_file.as_posix()}'")
+    report_peak_memory(max_memory)
+
+
+def report_peak_memory(max_memory: int | None):
+    # ru_maxrss is never reset: in batch/watch, this is the peak of every song
+    # processed so far by this process, not of the last one
+    if max_memory is None:
+        return
+    peak = peak_memory()
+    if peak is None:
+        logger.info("Process peak memory usage is not available on this platform")
+        return
+    peak_mib = peak / 2**20
+    logger.info(f"Process peak memory usage so far: {peak_mib:.0f} MiB")
+    if peak_mib > max_memory:
+        logger.warning(
+            f"Process peak memory usage exceeded the {max_memory} MiB budget"
+        )
+
+
+def get_preflight(min_score: float | None, max_tokens_per_second: float | None):
+    if min_score is None and max_tokens_per_second is None:
+        return None
+    return {"min_score": min_score, "max_tokens_per_second": max_tokens_per_second}
+
+
+def get_resources(
+    separation_threads: int | None,
+    emission_threads: int | None,
+    alignment_threads: int | None,
+    interop_threads: int | None,
+):
+    return ResourceConfig(
+        separation=StageThreads(separation_threads),
+        emission=StageThreads(emission_threads),
+        alignment=StageThreads(alignment_threads),
+        inter_op=interop_threads,
+    )
@@ -1,5 +1,8 @@
 import logging
 import subprocess
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 
@@ -12,12 +15,12 @@ from yohane.audio import HybridDemucsSeparator, Separator, VocalRemoverSeparator
 logger = logging.getLogger(__name__)
 
 
-def parse_song_argument(value: str) -> Path:
+def parse_song_argument(value: str, audio_only: bool = False) -> Path:
     song_path = Path(value)
 
     if not song_path.is_file():
         logger.info("Song file not found, calling yt-dlp")
-        song_path = ydl_download(value)
+        song_path = ydl_download(value, audio_only=audio_only)
 
     if "ffmpeg" not in torchaudio.list_audio_backends():
         logger.info(
@@ -30,13 +33,48 @@ def parse_song_argument(value: str) -> Path:
     return song_path
 
 
-def ydl_download(value: str) -> Path:
-    with YoutubeDL({"format_sort": ["res:1080", "vcodec:h264", "acodec:aac"]}) as ydl:
+def ydl_download(
+    value: str,
+    audio_only: bool = False,
+    ydl_factory: Callable[[dict], YoutubeDL] = YoutubeDL,
+) -> Path:
+    if audio_only:
+        # a single audio stream: no video download and no muxing step
+        params = {"format": "bestaudio/best"}
+    else:
+        params = {"format_sort": ["res:1080", "vcodec:h264", "acodec:aac"]}
+    with ydl_factory(params) as ydl:
         info = ydl.extract_info(value)
         filename = ydl.prepare_filename(info)
         return Path(filename)
 
 
+def prefetch_songs(
+    values: Iterable[str],
+    depth: int = 2,
+    resolve: Callable[[str], Path] = parse_song_argument,
+) -> Iterator[Path]:
+    """
+    Resolve song arguments in order, downloading the next `depth` ones in the
+    background while the current one is being processed.
+    """
+    values_iter = iter(values)
+    pending: deque[Future[Path]] = deque()
+    with ThreadPoolExecutor(max_workers=depth + 1) as executor:
+        try:
+            while True:
+                for value in values_iter:
+                    pending.append(executor.submit(resolve, value))
+                    if len(pending) > depth:
+                        break
+                if not pending:
+                    return
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 def ffmpeg_wav(song_path: Path) -> Path:
     wav_path = song_path.with_suffix(".wav")
     proc = subprocess.run(["ffmpeg", "-y", "-i", song_path, wav_path])
@@ -3,6 +3,9 @@ from pathlib import Path
 
 import click
 
+from yohane.corpus import CorpusIndex
+from yohane.lyrics import RichText
+
 logger = logging.getLogger(__name__)
 
 
@@ -15,3 +18,17 @@ def parse_lyrics_argument(value: Path | None) -> str:
     if input is None:
         raise click.MissingParameter(param_type="argument", param_hint="'LYRICS_FILE'")
     return input
+
+
+def load_lyrics(
+    value: Path | None, index: CorpusIndex | None = None
+) -> tuple[RichText, list[list[int]] | None]:
+    """
+    Lyrics and their transcript token IDs, taken from the corpus index when
+    the lyrics text is found in it.
+    """
+    text = parse_lyrics_argument(value)
+    if index is not None and (indexed := index.get(text)) is not None:
+        logger.info("Loading the lyrics from the lyrics index")
+        return indexed
+    return RichText.parse(text), None
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# by order of preference when several songs share the same name
+SONG_SUFFIXES = [
+    ".mkv",
+    ".mp4",
+    ".webm",
+    ".flac",
+    ".m4a",
+    ".opus",
+    ".ogg",
+    ".mp3",
+    ".wav",
+]
+LYRICS_SUFFIX = ".txt"
+STATE_FILENAME = ".yohane-watch.json"
+
+
+@dataclass
+class WatchedFile:
+    stat: tuple[int, int]  # size, mtime
+    since: float  # monotonic time at which this stat was first seen
+    digest: str | None = None
+
+
+@dataclass
+class WatchJob:
+    song: Path
+    lyrics: Path
+    key: str
+
+
+class FolderWatcher:
+    """
+    Pairs song files with the lyrics file of the same name (`song.mp4` with
+    `song.txt`) in a directory.
+
+    Files are only considered once their size and modification time have not
+    changed for `settle` seconds. Each pair is identified by the hash of the
+    audio, the lyrics and the settings, so a pair is never processed twice
+    even if its files are re-saved or renamed.
+    """
+
+    def __init__(self, directory: Path, settings: dict, settle: float = 5.0):
+        self.directory = directory
+        self.settings = json.dumps(settings, sort_keys=True)
+        self.settle = settle
+        self.state_file = directory / STATE_FILENAME
+        self.files: dict[Path, WatchedFile] = {}
+        self.processed: set[str] = set()
+        self.pending: set[str] = set()
+        if self.state_file.is_file():
+            self.processed.update(json.loads(self.state_file.read_text()))
+
+    def scan(self, limit: int | None = None) -> list[WatchJob]:
+        """
+        Return at most `limit` settled pairs that have not been processed yet.
+        They are considered pending until `done` or `failed` is called.
+        """
+        now = time.monotonic()
+        songs: dict[str, Path] = {}
+        lyrics: dict[str, Path] = {}
+        seen = set()
+
+        for path in self.directory.iterdir():
+            if not path.is_file() or path.name == STATE_FILENAME:
+                continue
+            suffix = path.suffix.lower()
+            if suffix != LYRICS_SUFFIX and suffix not in SONG_SUFFIXES:
+                continue
+            if not self._update(path, now):
+                continue  # removed since listed, see next scan
+            seen.add(path)
+            if suffix == LYRICS_SUFFIX:
+                lyrics[path.stem] = path
+            else:
+                current = songs.get(path.stem)
+                if current is None or _preference(path) < _preference(current):
+                    songs[path.stem] = path
+
+        for path in self.files.keys() - seen:
+            del self.files[path]
+
+        jobs = []
+        for stem, song in sorted(songs.items()):
+            if limit is not None and len(jobs) >= limit:
+                break
+            lyrics_file = lyrics.get(stem)
+            if lyrics_file is None:
+                continue
+            if not (self._settled(song, now) and self._settled(lyrics_file, now)):
+                continue
+            try:
+                key = self._job_key(song, lyrics_file)
+            except OSError as e:
+                logger.debug(f"Skipping '{song.name}' until next scan: {e}")
+                continue
+            if key in self.processed or key in self.pending:
+                continue
+            self.pending.add(key)
+            jobs.append(WatchJob(song, lyrics_file, key))
+        return jobs
+
+    def done(self, job: WatchJob):
+        self.pending.discard(job.key)
+        self.processed.add(job.key)
+        self.state_file.write_text(json.dumps(sorted(self.processed)))
+
+    def failed(self, job: WatchJob):
+        # keep it pending so that it is not retried until one of its files changes
+        logger.warning(f"Giving up on '{job.song.name}' until its files change")
+
+    def _update(self, path: Path, now: float):
+        """
+        Returns False if the file cannot be read anymore.
+        """
+        try:
+            stat = path.stat()
+        except OSError:
+            return False
+        current = (stat.st_size, stat.st_mtime_ns)
+        watched = self.files.get(path)
+        if watched is None or watched.stat != current:
+            self.files[path] = WatchedFile(current, now)
+        return True
+
+    def _settled(self, path: Path, now: float):
+        return now - self.files[path].since >= self.settle
+
+    def _digest(self, path: Path):
+        watched = self.files[path]
+        if watched.digest is None:
+            h = hashlib.sha256()
+            with path.open("rb") as f:
+                while chunk := f.read(1 << 20):
+                    h.update(chunk)
+            watched.digest = h.hexdigest()
+        return watched.digest
+
+    def _job_key(self, song: Path, lyrics: Path):
+        h = hashlib.sha256()
+        h.update(self._digest(song).encode())
+        h.update(self._digest(lyrics).encode())
+        h.update(self.settings.encode())
+        return h.hexdigest()
+
+
+def _preference(path: Path):
+    return SONG_SUFFIXES.index(path.suffix.lower())
@@ -1,11 +1,13 @@
 import logging
+import math
 from abc import ABC, abstractmethod
+from collections.abc import Iterator
+from functools import cache, cached_property
 from importlib.resources import as_file, files
 from pathlib import Path
 from typing import cast
 
 import torch
-import torchaudio
 import vocal_remover.models
 from torchaudio.pipelines import HDEMUCS_HIGH_MUSDB_PLUS
 from torchaudio.pipelines import MMS_FA as fa_bundle
@@ -13,46 +15,232 @@ from torchaudio.transforms import Fade
 from vocal_remover.inference import Separator as VocalRemoverBaseSeparator
 from vocal_remover.lib import nets, spec_utils
 
+from yohane.resampling import Resampler, resample
+
 logger = logging.getLogger(__name__)
 
 
-def compute_alignments(waveform: torch.Tensor, sample_rate: int, transcript: list[str]):
+@cache
+def get_fa_model() -> torch.nn.Module:
+    return fa_bundle.get_model()
+
+
+def compute_alignments(
+    waveform: torch.Tensor,
+    sample_rate: int,
+    transcript: list[str],
+    resampler: Resampler = resample,
+):
     """
     https://pytorch.org/audio/stable/tutorials/forced_alignment_for_multilingual_data_tutorial.html
     """
+    emission = compute_emission(waveform, sample_rate, resampler)
+    token_spans = align_emission(emission, transcript)
+    return emission, token_spans
+
+
+def compute_emission(
+    waveform: torch.Tensor, sample_rate: int, resampler: Resampler = resample
+):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     logger.info(f"Using {device=}")
 
-    waveform = waveform.mean(0, keepdim=True)
-    waveform, sample_rate = (
-        torchaudio.functional.resample(
-            waveform, sample_rate, int(fa_bundle.sample_rate)
-        ),
-        int(fa_bundle.sample_rate),
-    )
+    fa_sample_rate = int(fa_bundle.sample_rate)
+    resampled = resampler.cached(waveform, sample_rate, fa_sample_rate)
+    if resampled is not None:
+        waveform = resampled.mean(0, keepdim=True)
+    else:
+        # downmix first, the mono waveform is not worth memoizing
+        waveform = resample(waveform.mean(0, keepdim=True), sample_rate, fa_sample_rate)
+    sample_rate = fa_sample_rate
 
-    model = fa_bundle.get_model()
+    model = get_fa_model()
     model.to(device)
 
+    with torch.inference_mode():
+        emission, _ = model(waveform.to(device))
+        emission = cast(torch.Tensor, emission)
+
+    return emission
+
+
+def align_emission(
+    emission: torch.Tensor,
+    transcript: list[str],
+    tokens: list[list[int]] | None = None,
+):
+    """
+    `tokens` can be given if the transcript has already been tokenized.
+    """
     tokenizer = fa_bundle.get_tokenizer()
     aligner = fa_bundle.get_aligner()
 
     with torch.inference_mode():
-        emission, _ = model(waveform.to(device))
-        emission = cast(torch.Tensor, emission)
-        tokens = tokenizer(transcript)
-        tokens = cast(list[list[int]], tokens)
+        if tokens is None:
+            tokens = cast(list[list[int]], tokenizer(transcript))
         token_spans = aligner(emission[0], tokens)
 
-    return emission, token_spans
+    return token_spans
+
+
+class StreamingEmission:
+    """
+    Computes the emission of a waveform fed chunk by chunk.
+
+    The audio is processed in windows whose boundaries fall on the model frame
+    grid, so the concatenated emission has the same number of frames as the
+    emission of the whole waveform. Each window is resampled from the input
+    audio with a margin around it, starting on the resampling period, so it
+    matches the same range of a whole-waveform resampling.
+
+    The model sees `context` seconds of audio on each side of a window, and
+    the frames of this context are dropped, so that the frames near the
+    window boundaries are not computed on truncated audio.
+    """
+
+    # wav2vec2 feature extractor: 400 samples receptive field, 320 samples stride
+    FRAME_STRIDE = 320
+    FRAME_CONTEXT = 400 - 320
+    # input samples on each side of a window, more than the resampling filter
+    RESAMPLING_MARGIN = 1024
+
+    def __init__(
+        self,
+        sample_rate: int,
+        window: float = 30.0,
+        context: float = 3.0,
+        resampler: Resampler = resample,
+    ):
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        logger.info(f"Using {self.device=}")
+
+        self.sample_rate = sample_rate
+        self.resampler = resampler
+        self.model = get_fa_model()
+        self.model.to(self.device)
+
+        self.fa_sample_rate = int(fa_bundle.sample_rate)
+        self.window_len = (
+            int(window * self.fa_sample_rate) // self.FRAME_STRIDE * self.FRAME_STRIDE
+        )
+        self.context_len = (
+            int(context * self.fa_sample_rate) // self.FRAME_STRIDE * self.FRAME_STRIDE
+        )
+        # resampling maps every `orig_step` input samples to `new_step` samples
+        gcd = math.gcd(sample_rate, self.fa_sample_rate)
+        self.orig_step = sample_rate // gcd
+        self.new_step = self.fa_sample_rate // gcd
+
+        # mono input samples, the first one being at index `buffer_start`
+        self.buffer = torch.zeros(1, 0, device=self.device)
+        self.buffer_start = 0
+        self.received = 0
+        # start of the next window, in resampled samples
+        self.window_start = 0
+        self.emissions: list[torch.Tensor] = []
+
+    def feed(self, chunk: torch.Tensor):
+        chunk = chunk.mean(0, keepdim=True) if chunk.ndim > 1 else chunk[None]
+        self.buffer = torch.cat((self.buffer, chunk.to(self.device)), dim=1)
+        self.received += chunk.size(1)
+        while True:
+            window_end = (
+                self.window_start
+                + self.window_len
+                + self.context_len
+                + self.FRAME_CONTEXT
+            )
+            if self.received < self._input_end(window_end):
+                break
+            self._process(window_end, self.window_len // self.FRAME_STRIDE)
+            self.window_start += self.window_len
+            drop = self._input_start(self._context_start()) - self.buffer_start
+            self.buffer = self.buffer[:, drop:]
+            self.buffer_start += drop
+
+    def finish(self) -> torch.Tensor:
+        length = math.ceil(self.received * self.fa_sample_rate / self.sample_rate)
+        if length - self.window_start >= self.FRAME_STRIDE + self.FRAME_CONTEXT:
+            self._process(length)
+        self.buffer = self.buffer[:, :0]
+        if not self.emissions:
+            # too short for a single frame: empty emission with the label axis
+            with torch.inference_mode():
+                emission, _ = self.model(torch.zeros(1, 400, device=self.device))
+            return cast(torch.Tensor, emission)[:, :0]
+        return torch.cat(self.emissions, dim=1)
+
+    def _context_start(self):
+        return max(0, self.window_start - self.context_len)
+
+    def _input_start(self, start: int):
+        """
+        First input sample needed to resample from `start`, on the resampling
+        period so that the output samples are the same as a whole pass.
+        """
+        first = start * self.sample_rate // self.fa_sample_rate
+        first = max(0, first - self.RESAMPLING_MARGIN)
+        return first // self.orig_step * self.orig_step
+
+    def _input_end(self, end: int):
+        return (
+            math.ceil(end * self.sample_rate / self.fa_sample_rate)
+            + self.RESAMPLING_MARGIN
+        )
+
+    def _resampled(self, start: int, end: int):
+        """
+        Resampled samples [start, end) of the input received so far.
+        """
+        input_start = self._input_start(start)
+        input_end = min(self._input_end(end), self.received)
+        waveform = self.buffer[
+            :, input_start - self.buffer_start : input_end - self.buffer_start
+        ]
+        waveform = self.resampler(waveform, self.sample_rate, self.fa_sample_rate)
+        offset = input_start // self.orig_step * self.new_step
+        return waveform[:, start - offset : end - offset]
+
+    def _process(self, end: int, nb_frames: int | None = None):
+        """
+        Emission of the current window, computed up to `end` with the context
+        before it. `nb_frames` frames are kept, all the remaining ones if None.
+        """
+        start = self._context_start()
+        first = (self.window_start - start) // self.FRAME_STRIDE
+        last = None if nb_frames is None else first + nb_frames
+        with torch.inference_mode():
+            emission, _ = self.model(self._resampled(start, end))
+            self.emissions.append(cast(torch.Tensor, emission)[:, first:last])
 
 
 class Separator(ABC):
     @abstractmethod
     def __call__(
-        self, waveform: torch.Tensor, sample_rate: int
+        self, waveform: torch.Tensor, sample_rate: int, resampler: Resampler = resample
     ) -> tuple[torch.Tensor, int]: ...
 
+    def stream(
+        self, waveform: torch.Tensor, sample_rate: int, resampler: Resampler = resample
+    ) -> Iterator[tuple[torch.Tensor, int]]:
+        """
+        Yield the vocals chunk by chunk, as soon as they are separated.
+        """
+        yield self(waveform, sample_rate, resampler)
+
+    @property
+    def streaming(self):
+        """
+        Whether `stream` yields the vocals before the whole song is separated.
+        """
+        return type(self).stream is not Separator.stream
+
+    def share_memory(self):
+        """
+        Load the model and move its weights to shared memory, so that forked
+        workers can use it without their own copy.
+        """
+
 
 class VocalRemoverSeparator(Separator):
     """
@@ -80,24 +268,37 @@ class VocalRemoverSeparator(Separator):
             with as_file(state_resource) as path:
                 self.pretrained_model = path
 
-    def __call__(self, waveform: torch.Tensor, sample_rate: int):
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        logger.info(f"Using {device=}")
-
+    @cached_property
+    def model(self):
         model = nets.CascadedNet(self.n_fft, self.hop_length, 32, 128)
         model.load_state_dict(
             torch.load(self.pretrained_model, map_location="cpu", weights_only=True)
         )
+        return model
+
+    def share_memory(self):
+        self.model.share_memory()
+
+    def __call__(
+        self, waveform: torch.Tensor, sample_rate: int, resampler: Resampler = resample
+    ):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        logger.info(f"Using {device=}")
+
+        model = self.model
         model.to(device)
 
-        waveform = waveform.repeat(2, 1) if waveform.ndim == 1 else waveform
+        if waveform.ndim == 1 or waveform.size(0) == 1:
+            waveform = waveform.reshape(1, -1).repeat(2, 1)
 
         waveform_spec = spec_utils.wave_to_spectrogram(
             waveform.numpy(), self.hop_length, self.n_fft
         )
+        del waveform
 
         sp = VocalRemoverBaseSeparator(model, device, self.batchsize, self.cropsize)
         _, vocals_spec = sp.separate(waveform_spec)
+        del waveform_spec
 
         vocals = spec_utils.spectrogram_to_wave(vocals_spec, hop_length=self.hop_length)
 
@@ -115,14 +316,39 @@ class HybridDemucsSeparator(Separator):
         self.segment = segment
         self.overlap = overlap
 
+    @cached_property
+    def model(self) -> torch.nn.Module:
+        return self.bundle.get_model()
+
+    def share_memory(self):
+        self.model.share_memory()
+
     def separate_sources(
         self,
         mix: torch.Tensor,
         sample_rate: int,
         model: torch.nn.Module,
         device: torch.device,
+        source_idx: int | None = None,
     ):
+        """
+        If `source_idx` is given, only this source is kept in the output.
+        """
+        chunks = self.iter_separate_sources(mix, sample_rate, model, source_idx)
+        return torch.cat(list(chunks), dim=-1).to(device)
+
+    def iter_separate_sources(
+        self,
+        mix: torch.Tensor,
+        sample_rate: int,
+        model: torch.nn.Module,
+        source_idx: int | None = None,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Yield the separated sources as soon as their overlap-add is complete.
+        """
         batch, channels, length = mix.shape
+        nb_sources = len(model.sources) if source_idx is None else 1
 
         chunk_len = int(sample_rate * self.segment * (1 + self.overlap))
         start = 0
@@ -132,14 +358,19 @@ class HybridDemucsSeparator(Separator):
             fade_in_len=0, fade_out_len=int(overlap_frames), fade_shape="linear"
         )
 
-        final = torch.zeros(batch, len(model.sources), channels, length, device=device)
+        # faded tail of the previous chunk, which overlaps the current one
+        carry: torch.Tensor | None = None
 
         while start < length - overlap_frames:
             chunk = mix[:, :, start:end]
             with torch.no_grad():
                 out = model.forward(chunk)
+            if source_idx is not None:
+                out = out[:, source_idx : source_idx + 1]
             out = fade(out)
-            final[:, :, :, start:end] += out
+            if carry is not None:
+                out[..., : carry.size(-1)] += carry
+            previous_start = start
             if start == 0:
                 fade.fade_in_len = int(overlap_frames)
                 start += int(chunk_len - overlap_frames)
@@ -148,32 +379,50 @@ class HybridDemucsSeparator(Separator):
             end += chunk_len
             if end >= length:
                 fade.fade_out_len = 0
-        return final
+            split = start - previous_start
+            yield out[..., :split]
+            carry = out[..., split:]
+
+        if carry is None:
+            # the mix is not longer than the overlap: nothing was separated
+            yield mix.new_zeros(batch, nb_sources, channels, length)
+        elif carry.size(-1) > 0:
+            yield carry
 
-    def __call__(self, waveform: torch.Tensor, sample_rate: int):
+    def __call__(
+        self, waveform: torch.Tensor, sample_rate: int, resampler: Resampler = resample
+    ):
+        chunks = []
+        vocals_sample_rate = self.bundle.sample_rate
+        for chunk, vocals_sample_rate in self.stream(waveform, sample_rate, resampler):
+            chunks.append(chunk)
+        return torch.cat(chunks, dim=-1), vocals_sample_rate
+
+    def stream(
+        self, waveform: torch.Tensor, sample_rate: int, resampler: Resampler = resample
+    ):
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         logger.info(f"Using {device=}")
 
         waveform, sample_rate = (
-            torchaudio.functional.resample(
-                waveform, sample_rate, self.bundle.sample_rate
-            ),
+            resampler(waveform, sample_rate, self.bundle.sample_rate),
             self.bundle.sample_rate,
         )
         waveform = waveform.to(device)
+        if waveform.size(0) == 1:
+            waveform = waveform.expand(2, -1)  # the model expects stereo
 
-        model = self.bundle.get_model()
+        model = self.model
         model.to(device)
 
         ref = waveform.mean(0)
-        waveform = (waveform - ref.mean()) / ref.std()  # normalization
-
-        sources = self.separate_sources(waveform[None], sample_rate, model, device)[0]
-        sources = sources * ref.std() + ref.mean()
+        ref_mean, ref_std = ref.mean(), ref.std()
+        waveform = (waveform - ref_mean) / ref_std  # normalization
+        del ref
 
-        sources_list = model.sources
-        sources = list(sources)
-
-        audios = dict(zip(sources_list, sources))
-
-        return audios["vocals"], sample_rate
+        vocals_idx = cast(list[str], model.sources).index("vocals")
+        sources = self.iter_separate_sources(
+            waveform[None], sample_rate, model, source_idx=vocals_idx
+        )
+        for chunk in sources:
+            yield chunk[0, 0] * ref_std + ref_mean, sample_rate
@@ -0,0 +1,227 @@
+import hashlib
+import logging
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+from torchaudio.pipelines import MMS_FA as fa_bundle
+
+from yohane.lyrics import RichText, Ruby, Syllable, normalize_uroman
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class PreprocessedLyrics:
+    name: str
+    digest: str
+    romanized: str
+    lines: list[list[str | Ruby]]
+    syllables: list[list[Syllable]]
+    tokens: list[list[int]]
+
+
+def lyrics_digest(text: str):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def preprocess_lyrics(lyrics_file: Path) -> PreprocessedLyrics:
+    """
+    Parse, split and romanize a `[kanji](furigana)` lyrics file, and tokenize
+    its transcript for the alignment model.
+    """
+    raw = lyrics_file.read_text()
+    lyrics = RichText.parse(raw)
+    romanized = str(lyrics.romanized)
+    transcript = normalize_uroman(romanized).split()
+    tokens = fa_bundle.get_tokenizer()(transcript)
+    return PreprocessedLyrics(
+        lyrics_file.stem,
+        lyrics_digest(raw),
+        romanized,
+        [line.raw for line in lyrics.lines],
+        [line.syllables for line in lyrics.lines],
+        tokens,
+    )
+
+
+class _StringColumn:
+    """
+    Strings stored as one UTF-8 buffer and their end offsets.
+    """
+
+    def __init__(self, data: torch.Tensor, ends: torch.Tensor):
+        self.data = data
+        self.ends = ends
+
+    @classmethod
+    def pack(cls, values: Iterable[str]):
+        encoded = [value.encode() for value in values]
+        buffer = bytearray(b"".join(encoded))
+        if buffer:
+            data = torch.frombuffer(buffer, dtype=torch.uint8).clone()
+        else:
+            data = torch.empty(0, dtype=torch.uint8)
+        ends = _offsets(len(value) for value in encoded)[1:]
+        return cls(data, ends)
+
+    def __getitem__(self, idx: int) -> str:
+        start = int(self.ends[idx - 1]) if idx > 0 else 0
+        return self.data[start : int(self.ends[idx])].numpy().tobytes().decode()
+
+    def slice(self, start: int, stop: int) -> list[str]:
+        return [self[idx] for idx in range(start, stop)]
+
+
+def _offsets(lengths: Iterable[int]) -> torch.Tensor:
+    lengths = torch.tensor([0, *lengths], dtype=torch.int64)
+    return lengths.cumsum(0)
+
+
+class CorpusIndex:
+    """
+    Columnar index of preprocessed lyrics, keyed by the SHA-256 of the lyrics
+    text, so an edited file is never served stale. Loading a song from the
+    index skips parsing, romanization and tokenization.
+
+    Line elements are stored as their text and their ruby text, which is
+    empty for plain text.
+    """
+
+    STRING_COLUMNS = (
+        "names",
+        "digests",
+        "romanized",
+        "text",
+        "rt",
+        "kana",
+        "kanji",
+        "roman",
+    )
+
+    def __init__(self, columns: dict[str, torch.Tensor]):
+        self.columns = columns
+        self.strings = {
+            name: _StringColumn(columns[f"{name}.data"], columns[f"{name}.ends"])
+            for name in self.STRING_COLUMNS
+        }
+        nb_songs = len(columns["song_lines"]) - 1
+        self.names = self.strings["names"].slice(0, nb_songs)
+        self.keys = {
+            digest: idx
+            for idx, digest in enumerate(self.strings["digests"].slice(0, nb_songs))
+        }
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, records: list[PreprocessedLyrics]):
+        lines = [line for record in records for line in record.lines]
+        elements = [element for line in lines for element in line]
+        line_syllables = [line for record in records for line in record.syllables]
+        syllables = [syllable for line in line_syllables for syllable in line]
+        words = [word for record in records for word in record.tokens]
+        columns = {
+            "song_lines": _offsets(len(record.lines) for record in records),
+            "line_elements": _offsets(len(line) for line in lines),
+            "line_syllables": _offsets(len(line) for line in line_syllables),
+            "song_words": _offsets(len(record.tokens) for record in records),
+            "word_tokens": _offsets(len(word) for word in words),
+            "tokens": torch.tensor(
+                [token for word in words for token in word], dtype=torch.int32
+            ),
+        }
+        strings = {
+            "names": (record.name for record in records),
+            "digests": (record.digest for record in records),
+            "romanized": (record.romanized for record in records),
+            "text": (
+                element.rb if isinstance(element, Ruby) else element
+                for element in elements
+            ),
+            "rt": (
+                element.rt if isinstance(element, Ruby) else "" for element in elements
+            ),
+            "kana": (syllable.kana for syllable in syllables),
+            "kanji": (syllable.kanji or "" for syllable in syllables),
+            "roman": (syllable.roman for syllable in syllables),
+        }
+        for name, values in strings.items():
+            column = _StringColumn.pack(values)
+            columns[f"{name}.data"] = column.data
+            columns[f"{name}.ends"] = column.ends
+        return cls(columns)
+
+    def save(self, path: Path):
+        torch.save(self.columns, path)
+
+    @classmethod
+    def load(cls, path: Path):
+        return cls(torch.load(path, mmap=True, weights_only=True))
+
+    def get(self, text: str) -> tuple[RichText, list[list[int]]] | None:
+        """
+        The lyrics of `text`, with their lines, syllables and romanization
+        already computed, and the token IDs of their transcript. None if
+        this text is not in the index.
+        """
+        idx = self.keys.get(lyrics_digest(text))
+        if idx is None:
+            return None
+
+        song_lines = self.columns["song_lines"]
+        line_elements = self.columns["line_elements"]
+        line_syllables = self.columns["line_syllables"]
+        lines = []
+        for line_idx in range(int(song_lines[idx]), int(song_lines[idx + 1])):
+            start = int(line_elements[line_idx])
+            stop = int(line_elements[line_idx + 1])
+            line = RichText(
+                [
+                    Ruby(text, rt) if rt else text
+                    for text, rt in zip(
+                        self.strings["text"].slice(start, stop),
+                        self.strings["rt"].slice(start, stop),
+                    )
+                ]
+            )
+            start = int(line_syllables[line_idx])
+            stop = int(line_syllables[line_idx + 1])
+            # cached properties are stored in the instance dict
+            line.__dict__["syllables"] = [
+                Syllable(kana, kanji or None, roman)
+                for kana, kanji, roman in zip(
+                    self.strings["kana"].slice(start, stop),
+                    self.strings["kanji"].slice(start, stop),
+                    self.strings["roman"].slice(start, stop),
+                )
+            ]
+            lines.append(line)
+
+        raw: list[str | Ruby] = []
+        for line in lines:
+            raw.extend(line.raw)
+            raw.append("\n")
+        lyrics = RichText(raw)
+        lyrics.__dict__["lines"] = lines
+        lyrics.__dict__["romanized"] = RichText([self.strings["romanized"][idx]])
+
+        song_words = self.columns["song_words"]
+        word_tokens = self.columns["word_tokens"]
+        tokens = self.columns["tokens"]
+        words = []
+        for word_idx in range(int(song_words[idx]), int(song_words[idx + 1])):
+            start, stop = int(word_tokens[word_idx]), int(word_tokens[word_idx + 1])
+            words.append(tokens[start:stop].tolist())
+
+        return lyrics, words
+
+
+def build_corpus_index(lyrics_files: list[Path], workers: int | None = None):
+    logger.info(f"Preprocessing {len(lyrics_files)} lyrics files")
+    with ProcessPoolExecutor(workers) as executor:
+        records = list(executor.map(preprocess_lyrics, lyrics_files, chunksize=16))
+    return CorpusIndex.build(records)
@@ -0,0 +1,389 @@
+import logging
+import sqlite3
+from collections import Counter
+from contextlib import closing
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+
+from yohane.resampling import Resampler, resample
+
+logger = logging.getLogger(__name__)
+
+# one fingerprint frame per MMS_FA emission frame (20 ms)
+FRAME_RATE = 50
+SAMPLE_RATE = 8000
+HOP_LENGTH = SAMPLE_RATE // FRAME_RATE
+N_FFT = 1024
+NB_BINS = 512  # 9 bits, the Nyquist bin is dropped
+
+# spectral peaks are local maxima over this neighbourhood (bins, frames)
+PEAK_NEIGHBOURHOOD = (31, 11)
+# each peak is paired with the next FAN_OUT peaks less than 64 frames later
+FAN_OUT = 5
+MAX_DELTA = 63  # 6 bits
+# below this number of expected votes, a window is too quiet to be matched
+MIN_WINDOW_VOTES = 4
+
+# the reused vocals are aligned on the stored mix, over this much audio
+ALIGNMENT_LENGTH = 5.0  # s
+# below this correlation with the stored mix, the song is another master and
+# the vocals of the recording cannot be subtracted from it
+MIN_CORRELATION = 0.8
+
+
+@dataclass
+class Fingerprint:
+    hashes: torch.Tensor  # (n,) int64
+    frames: torch.Tensor  # (n,) int64, frame of the anchor peak
+    nb_frames: int
+
+
+def compute_fingerprint(
+    waveform: torch.Tensor, sample_rate: int, resampler: Resampler = resample
+):
+    """
+    Landmark fingerprint: hashes of pairs of spectral peaks, with the time of
+    their first peak.
+    """
+    waveform = resampler(waveform, sample_rate, SAMPLE_RATE).mean(0).cpu()
+    spec = torch.stft(
+        waveform,
+        N_FFT,
+        HOP_LENGTH,
+        window=torch.hann_window(N_FFT),
+        return_complex=True,
+    )
+    spec = spec[:NB_BINS].abs().log1p()
+
+    pooled = F.max_pool2d(
+        spec[None, None],
+        PEAK_NEIGHBOURHOOD,
+        stride=1,
+        padding=(PEAK_NEIGHBOURHOOD[0] // 2, PEAK_NEIGHBOURHOOD[1] // 2),
+    )[0, 0]
+    threshold = spec.mean() + spec.std()
+    bins, frames = ((spec == pooled) & (spec > threshold)).nonzero(as_tuple=True)
+    order = torch.argsort(frames * NB_BINS + bins)
+    bins, frames = bins[order], frames[order]
+
+    hashes, anchors = [], []
+    for k in range(1, FAN_OUT + 1):
+        delta = frames[k:] - frames[:-k]
+        mask = (delta > 0) & (delta <= MAX_DELTA)
+        hashes.append(((bins[:-k] << 15) | (bins[k:] << 6) | delta)[mask])
+        anchors.append(frames[:-k][mask])
+
+    return Fingerprint(torch.cat(hashes), torch.cat(anchors), spec.size(1))
+
+
+@dataclass
+class FingerprintSegment:
+    offset: int  # recording frame = song frame + offset
+    start: int  # song frames [start, stop) found in the recording
+    stop: int
+    votes: int
+
+
+@dataclass
+class FingerprintMatch:
+    recording: int
+    segments: list[FingerprintSegment]  # disjoint, in song order
+
+    def covers(self, fingerprint: Fingerprint):
+        covered = sum(segment.stop - segment.start for segment in self.segments)
+        return covered >= fingerprint.nb_frames
+
+
+def _best_offset(votes: list[tuple[int, int]]) -> tuple[int | None, int]:
+    """
+    Offset with the most (song frame, offset) votes, and its number of votes.
+    """
+    histogram = Counter(offset for _, offset in votes)
+    if not histogram:
+        return None, 0
+    # peaks of another encode can be shifted by a frame
+    return max(
+        (
+            (offset, histogram[offset - 1] + count + histogram[offset + 1])
+            for offset, count in histogram.items()
+        ),
+        key=lambda item: item[1],
+    )
+
+
+def align_waveforms(waveform: torch.Tensor, reference: torch.Tensor, max_lag: int):
+    """
+    Lag in [-max_lag, max_lag] at which the 1D `waveform` best matches the 1D
+    `reference`, which has `max_lag` more samples on each side. Also returns
+    the gain from the reference to the waveform and their normalized
+    correlation at this lag.
+    """
+    waveform, reference = waveform.double(), reference.double()
+    length = waveform.size(-1)
+    nb_lags = 2 * max_lag + 1
+    size = 1 << (length + reference.size(-1) - 1).bit_length()
+    spectrum = torch.fft.rfft(reference, size) * torch.fft.rfft(waveform, size).conj()
+    correlation = torch.fft.irfft(spectrum, size)[:nb_lags]
+    energy = F.pad(reference.square().cumsum(0), (1, 0))
+    energy = (energy[length : length + nb_lags] - energy[:nb_lags]).clamp_min(1e-12)
+    normalized = correlation / (waveform.square().sum() * energy).sqrt()
+    idx = int(normalized.argmax())
+    gain = float(correlation[idx] / energy[idx])
+    return idx - max_lag, gain, float(normalized[idx])
+
+
+class FingerprintIndex:
+    """
+    Local index of processed recordings, stored in a directory: fingerprints
+    in a SQLite database and the mix (downmixed), vocals and emission of each
+    recording next to it.
+
+    A song matching a recording can reuse its vocals and emission over the
+    overlapping segments, e.g. the parts of a TV size cut of a full version.
+
+    The song is matched window by window: a window of `window` seconds is
+    found at the offset of most of its votes, if they are at least
+    `min_density` of its hashes. Consecutive windows at the same offset make a
+    segment, kept if it lasts `min_overlap` seconds and its votes are also
+    dense enough.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        window: float = 3.0,
+        min_density: float = 0.1,
+        min_overlap: float = 5.0,
+    ):
+        self.directory = directory
+        self.window = window
+        self.min_density = min_density
+        self.min_overlap = min_overlap
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS recordings (
+                    id INTEGER PRIMARY KEY,
+                    separator TEXT NOT NULL,
+                    nb_frames INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS hashes (
+                    hash INTEGER NOT NULL,
+                    recording INTEGER NOT NULL,
+                    frame INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS hashes_hash ON hashes (hash);
+                """
+            )
+
+    def _connect(self):
+        # one connection per operation, so that the index can be used from
+        # forked workers and threads
+        return closing(sqlite3.connect(self.directory / "index.sqlite", timeout=60))
+
+    def _recording_dir(self, recording: int):
+        return self.directory / str(recording)
+
+    def match(self, fingerprint: Fingerprint, separator: str):
+        """
+        Segments of the song found in the best recording processed with the
+        same separator, if any.
+        """
+        query = list(zip(fingerprint.hashes.tolist(), fingerprint.frames.tolist()))
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE query (hash INTEGER, frame INTEGER)")
+            conn.executemany("INSERT INTO query VALUES (?, ?)", query)
+            row = conn.execute(
+                """
+                SELECT h.recording, r.nb_frames
+                FROM query q
+                JOIN hashes h ON h.hash = q.hash
+                JOIN recordings r ON r.id = h.recording
+                WHERE r.separator = ?
+                GROUP BY h.recording, h.frame - q.frame
+                ORDER BY COUNT(*) DESC
+                LIMIT 1
+                """,
+                (separator,),
+            ).fetchone()
+            if row is None:
+                return None
+            recording, nb_frames = row
+            votes = conn.execute(
+                """
+                SELECT q.frame, h.frame - q.frame
+                FROM query q
+                JOIN hashes h ON h.hash = q.hash
+                WHERE h.recording = ?
+                """,
+                (recording,),
+            ).fetchall()
+
+        segments = self._segments(fingerprint, votes, nb_frames)
+        if not segments:
+            return None
+        match = FingerprintMatch(recording, segments)
+        logger.info(f"Found a processed recording: {match}")
+        return match
+
+    def _segments(
+        self, fingerprint: Fingerprint, votes: list[tuple[int, int]], nb_frames: int
+    ):
+        """
+        Segments of the song found in a recording of `nb_frames` frames, from
+        the (song frame, offset) `votes` of its matching hashes.
+        """
+        window = round(self.window * FRAME_RATE)
+        nb_windows = -(-fingerprint.nb_frames // window)
+        nb_hashes = torch.bincount(
+            fingerprint.frames // window, minlength=nb_windows
+        ).tolist()
+        window_votes: list[list[tuple[int, int]]] = [[] for _ in range(nb_windows)]
+        for frame, offset in votes:
+            window_votes[frame // window].append((frame, offset))
+
+        # offset of each window, None if it is not found in the recording
+        offsets: list[int | None] = []
+        undecided = []
+        for idx, window_vote in enumerate(window_votes):
+            if nb_hashes[idx] * self.min_density < MIN_WINDOW_VOTES:
+                # too few peaks to tell, e.g. silence
+                offsets.append(None)
+                undecided.append(idx)
+                continue
+            offset, count = _best_offset(window_vote)
+            dense = count >= nb_hashes[idx] * self.min_density
+            offsets.append(offset if dense else None)
+        # undecided windows between two windows at the same offset follow them
+        for idx in undecided:
+            before = next((o for o in reversed(offsets[:idx]) if o is not None), None)
+            after = next((o for o in offsets[idx + 1 :] if o is not None), None)
+            if before is not None and after is not None and abs(before - after) <= 1:
+                offsets[idx] = before
+
+        segments = []
+        first = 0
+        for idx in range(1, nb_windows + 1):
+            previous = offsets[idx - 1]
+            current = offsets[idx] if idx < nb_windows else None
+            if (
+                previous is not None
+                and current is not None
+                and abs(current - previous) <= 1
+            ):
+                continue
+            if offsets[first] is not None:
+                segment = self._segment(
+                    window_votes[first:idx],
+                    sum(nb_hashes[first:idx]),
+                    first * window,
+                    min(idx * window, fingerprint.nb_frames),
+                    fingerprint.nb_frames,
+                    nb_frames,
+                )
+                if segment is not None:
+                    segments.append(segment)
+            first = idx
+        return segments
+
+    def _segment(
+        self,
+        window_votes: list[list[tuple[int, int]]],
+        nb_hashes: int,
+        start: int,
+        stop: int,
+        song_frames: int,
+        recording_frames: int,
+    ):
+        """
+        Segment of the song frames [start, stop) found in a recording, given
+        the votes of its windows.
+        """
+        offset, count = _best_offset([vote for votes in window_votes for vote in votes])
+        if offset is None or count < nb_hashes * self.min_density:
+            return None
+
+        # the recording bounds are exact, the other bounds are at the first and
+        # last peaks found at this offset: the segment can be an edit
+        first, last = (
+            [frame for frame, other in votes if abs(other - offset) <= 1]
+            for votes in (window_votes[0], window_votes[-1])
+        )
+        if start > 0 and start > -offset:
+            start = max(start, min(first, default=start))
+        if stop < song_frames and stop < recording_frames - offset:
+            stop = min(stop, max(last, default=stop - 1) + 1)
+        start = max(start, -offset)
+        stop = min(stop, recording_frames - offset)
+        if stop - start < self.min_overlap * FRAME_RATE:
+            return None
+        return FingerprintSegment(offset, start, stop, count)
+
+    def add(
+        self,
+        fingerprint: Fingerprint,
+        separator: str,
+        mix: tuple[torch.Tensor, int],
+        vocals: tuple[torch.Tensor, int],
+        emission: torch.Tensor,
+    ):
+        with self._connect() as conn, conn:
+            cursor = conn.execute(
+                "INSERT INTO recordings (separator, nb_frames) VALUES (?, ?)",
+                (separator, fingerprint.nb_frames),
+            )
+            recording = cursor.lastrowid
+            assert recording is not None
+            recording_dir = self._recording_dir(recording)
+            recording_dir.mkdir(exist_ok=True)
+            waveform, sample_rate = mix
+            torch.save(
+                {"waveform": waveform.mean(0).cpu(), "sample_rate": sample_rate},
+                recording_dir / "mix.pt",
+            )
+            waveform, sample_rate = vocals
+            torch.save(
+                {"waveform": waveform.cpu().contiguous(), "sample_rate": sample_rate},
+                recording_dir / "vocals.pt",
+            )
+            torch.save(emission.cpu(), recording_dir / "emission.pt")
+            conn.executemany(
+                "INSERT INTO hashes VALUES (?, ?, ?)",
+                (
+                    (h, recording, frame)
+                    for h, frame in zip(
+                        fingerprint.hashes.tolist(), fingerprint.frames.tolist()
+                    )
+                ),
+            )
+        logger.info(f"Added recording {recording} to the fingerprint index")
+        return recording
+
+    def load_vocals(self, match: FingerprintMatch) -> tuple[torch.Tensor, int]:
+        vocals = torch.load(
+            self._recording_dir(match.recording) / "vocals.pt",
+            mmap=True,
+            weights_only=True,
+        )
+        return vocals["waveform"], vocals["sample_rate"]
+
+    def load_mix(self, match: FingerprintMatch) -> tuple[torch.Tensor, int] | None:
+        """
+        The downmixed recording, None for recordings indexed without it.
+        """
+        path = self._recording_dir(match.recording) / "mix.pt"
+        if not path.exists():
+            return None
+        mix = torch.load(path, mmap=True, weights_only=True)
+        return mix["waveform"], mix["sample_rate"]
+
+    def load_emission(self, match: FingerprintMatch) -> torch.Tensor:
+        return torch.load(
+            self._recording_dir(match.recording) / "emission.pt",
+            mmap=True,
+            weights_only=True,
+        )
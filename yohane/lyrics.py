@@ -5,7 +5,7 @@ import regex as re
 import uroman as ur
 
 uroman = ur.Uroman()   # load uroman data (takes about a second or so)
-@dataclass
+@dataclass(slots=True)
 class Ruby:
     rb: str
     rt: str
@@ -13,10 +13,10 @@ class Ruby:
     def __str__(self):
         return f"[{self.rb}]({self.rt})"
 
-@dataclass
+@dataclass(slots=True)
 class Syllable:
     kana: str
-    kanji: str
+    kanji: str | None
     roman: str
 
     def __str__(self):
@@ -0,0 +1,51 @@
+import logging
+import sys
+import tempfile
+from pathlib import Path
+
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def peak_memory() -> int | None:
+    """
+    Peak resident set size of the current process, in bytes.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class WaveformSpill:
+    """
+    Moves waveforms to memory-mapped temporary files so that the OS can page
+    them out between the stages that need them.
+    """
+
+    def __init__(self, directory: Path | None = None):
+        self._tmpdir = tempfile.TemporaryDirectory(
+            prefix="yohane-", dir=directory, ignore_cleanup_errors=True
+        )
+        self._count = 0
+
+    def __call__(self, waveform: torch.Tensor) -> torch.Tensor:
+        waveform = waveform.detach().to("cpu").contiguous()
+        path = Path(self._tmpdir.name) / f"{self._count}.bin"
+        self._count += 1
+        waveform.numpy().tofile(path)
+        mapped = torch.from_file(
+            path.as_posix(), shared=False, size=waveform.numel(), dtype=waveform.dtype
+        )
+        logger.debug(f"Spilled waveform of shape {tuple(waveform.shape)} to {path}")
+        return mapped.view(waveform.shape)
+
+    def cleanup(self):
+        self._tmpdir.cleanup()
@@ -1,24 +1,95 @@
 import logging
+import math
 from pathlib import Path
 
 import torch
+import torch.nn.functional as F
 import torchaudio
 from torchaudio.functional import TokenSpan
 
-from yohane.audio import Separator, compute_alignments
+from yohane.audio import (
+    Separator,
+    StreamingEmission,
+    align_emission,
+    compute_emission,
+    fa_bundle,
+)
+from yohane.fingerprint import (
+    ALIGNMENT_LENGTH,
+    FRAME_RATE,
+    MIN_CORRELATION,
+    Fingerprint,
+    FingerprintIndex,
+    FingerprintMatch,
+    FingerprintSegment,
+    align_waveforms,
+    compute_fingerprint,
+)
 from yohane.lyrics import RichText, normalize_uroman
+from yohane.memory import WaveformSpill
+from yohane.preflight import PreflightError, preflight
+from yohane.resampling import Resampler
+from yohane.resources import ResourceConfig
 from yohane.subtitles import make_ass
 
 logger = logging.getLogger(__name__)
 
+# shorter parts of a song are widened before separating them
+MIN_SEPARATION_LENGTH = 1.0  # s
+# the alignment model needs more than a frame of audio, rounded slices of a
+# few frames can be too short
+MIN_EMISSION_FRAMES = 5
+
 
 class Yohane:
-    def __init__(self, separator: Separator | None):
+    def __init__(
+        self,
+        separator: Separator | None,
+        low_memory: bool = False,
+        resources: ResourceConfig | None = None,
+        fingerprints: FingerprintIndex | None = None,
+    ):
+        """
+        With `low_memory`, the song is downmixed as soon as it is loaded and
+        the waveforms are kept in memory-mapped files between stages, and
+        resampled waveforms are not kept for reuse.
+
+        `resources` sets the number of threads used by each stage.
+
+        With `fingerprints` (and a separator), the vocals and emission of an
+        already processed version of the same recording are reused where the
+        song overlaps it, and the song is added to the index once aligned.
+        """
         self.separator = separator
+        self.fingerprints = fingerprints if separator is not None else None
+        self.resources = resources or ResourceConfig()
+        self.spill = WaveformSpill() if low_memory else None
+        self.resampler = Resampler(memoize=not low_memory)
         self.song: tuple[torch.Tensor, int] | None = None
+        self.song_emission: torch.Tensor | None = None
         self.vocals: tuple[torch.Tensor, int] | None = None
         self.lyrics: RichText | None = None
+        self.tokens: list[list[int]] | None = None
         self.forced_alignment: tuple[torch.Tensor, list[list[TokenSpan]]] | None = None
+        self.fingerprint: Fingerprint | None = None
+        self.reuse: FingerprintMatch | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release the waveforms and remove the spilled files, if any.
+        """
+        self.song = None
+        self.song_emission = None
+        self.vocals = None
+        self.forced_alignment = None
+        if self.spill is not None:
+            self.spill.cleanup()
 
     @property
     def forced_aligned_audio(self):
@@ -29,31 +100,143 @@ class Yohane:
         if self.song is not None and self.vocals is not None:
             song_waveform, song_sample_rate = self.song
             vocals_waveform, vocals_sample_rate = self.vocals
-            vocals_waveform_resampled = torchaudio.functional.resample(
+            vocals_waveform_resampled = self.resampler(
                 vocals_waveform, vocals_sample_rate, song_sample_rate
             )
             return song_waveform - vocals_waveform_resampled, song_sample_rate
 
     def load_song(self, song_file: Path):
         logger.info("Loading song")
-        self.song = torchaudio.load(song_file.as_posix())
+        waveform, sample_rate = torchaudio.load(song_file.as_posix())
+        if self.spill is not None:
+            waveform = self.spill(waveform.mean(0, keepdim=True))
+        self.song = waveform, sample_rate
+        self.song_emission = None
+
+        if self.fingerprints is not None:
+            logger.info("Looking up the song in the fingerprint index")
+            self.fingerprint = compute_fingerprint(*self.song, self.resampler)
+            self.reuse = self.fingerprints.match(
+                self.fingerprint, type(self.separator).__name__
+            )
+
+    def preflight(self, **kwargs):
+        """
+        Check that the lyrics roughly fit the song before extracting the vocals.
+        Raises `PreflightError` on obvious mismatches. See `yohane.preflight`
+        for the arguments.
+
+        This is a full pass of the alignment model over the song. Its emission
+        is kept, to be reused by `force_align` if no vocals are extracted, so
+        the check is only free without a separator.
+        """
+        logger.info("Running preflight check")
+        assert self.song is not None and self.lyrics is not None
+        with self.resources.stage("emission"):
+            if self.song_emission is None:
+                self.song_emission = compute_emission(*self.song, self.resampler)
+            report = preflight(
+                *self.song,
+                self.transcript,
+                self.tokens,
+                resampler=self.resampler,
+                emission=self.song_emission,
+                **kwargs,
+            )
+        logger.info(f"Preflight: {report}")
+        if not report.ok:
+            raise PreflightError(f"Lyrics do not match the song: {report}")
+        return report
 
     def extract_vocals(self):
         if self.separator is not None:
             logger.info(f"Extracting vocals with {self.separator=}")
             assert self.song
-            self.vocals = self.separator(*self.song)
+            with self.resources.stage("separation"):
+                if self.reuse is not None:
+                    waveform, sample_rate = self._reuse_vocals(self.reuse)
+                else:
+                    waveform, sample_rate = self.separator(*self.song, self.resampler)
+            if self.spill is not None:
+                waveform = self.spill(waveform.mean(0, keepdim=True))
+            self.vocals = waveform, sample_rate
+            # only needed to align on the song itself
+            self.song_emission = None
 
-    def load_lyrics(self, lyrics_str: RichText):
+    def load_lyrics(self, lyrics_str: RichText, tokens: list[list[int]] | None = None):
+        """
+        `tokens` are the transcript token IDs, if they were precomputed.
+        """
         logger.info("Loading lyrics")
         self.lyrics = lyrics_str
+        self.tokens = tokens
+
+    @property
+    def transcript(self):
+        assert self.lyrics is not None
+        return normalize_uroman(str(self.lyrics.romanized)).split()
 
     def force_align(self):
         logger.info("Computing forced alignment")
         assert self.forced_aligned_audio is not None and self.lyrics is not None
-        self.forced_alignment = compute_alignments(
-            *self.forced_aligned_audio, normalize_uroman(str(self.lyrics.romanized)).split()
-        )
+        with self.resources.stage("emission"):
+            if self.reuse is not None and self.vocals is not None:
+                emission = self._reuse_emission(self.reuse)
+            elif self.vocals is None and self.song_emission is not None:
+                emission = self.song_emission
+            else:
+                emission = compute_emission(*self.forced_aligned_audio, self.resampler)
+        with self.resources.stage("alignment"):
+            token_spans = align_emission(emission, self.transcript, self.tokens)
+        self.forced_alignment = emission, token_spans
+        self._remember()
+
+    def extract_vocals_and_align(self):
+        """
+        Same as `extract_vocals` followed by `force_align`, but the emission of
+        each vocals chunk is computed as soon as the separator yields it.
+
+        Separators which only yield the whole vocals gain nothing from it, and
+        go through `extract_vocals` and `force_align`.
+        """
+        if (
+            self.separator is None
+            or not self.separator.streaming
+            or self.reuse is not None
+        ):
+            self.extract_vocals()
+            return self.force_align()
+
+        logger.info(f"Extracting vocals with {self.separator=} (streaming)")
+        assert self.song is not None and self.lyrics is not None
+        chunks = []
+        emission_stream = None
+        sample_rate = None
+        # both stages run interleaved, with the separation thread settings
+        with self.resources.stage("separation"):
+            stream = self.separator.stream(*self.song, self.resampler)
+            for chunk, sample_rate in stream:
+                if emission_stream is None:
+                    emission_stream = StreamingEmission(
+                        sample_rate, resampler=self.resampler
+                    )
+                emission_stream.feed(chunk)
+                chunks.append(chunk)
+            assert emission_stream is not None and sample_rate is not None
+            emission = emission_stream.finish()
+
+        waveform = torch.cat(chunks, dim=-1)
+        del chunks
+        if self.spill is not None:
+            waveform = self.spill(waveform.mean(0, keepdim=True))
+        self.vocals = waveform, sample_rate
+        self.song_emission = None
+
+        logger.info("Computing forced alignment")
+        with self.resources.stage("alignment"):
+            token_spans = align_emission(emission, self.transcript, self.tokens)
+        self.forced_alignment = emission, token_spans
+        self._remember()
 
     def make_subs(self):
         logger.info("Generating .ass")
@@ -64,3 +247,228 @@ class Yohane:
         )
         subs = make_ass(self.lyrics, *self.forced_aligned_audio, *self.forced_alignment)
         return subs
+
+    def _reuse_vocals(self, match: FingerprintMatch):
+        """
+        Vocals of the matched recording over the matching segments, and
+        separated from the song elsewhere.
+
+        The cached vocals are subtracted from the song for the off vocal track,
+        so each segment is aligned to the sample and scaled by correlating the
+        song with the stored mix. Segments which do not correlate with it (e.g.
+        another master) are separated too.
+        """
+        assert self.fingerprints is not None and self.song is not None
+        song, song_sample_rate = self.song
+        cached, sample_rate = self.fingerprints.load_vocals(match)
+        mix = self.fingerprints.load_mix(match)
+        # length of the vocals of the whole song, at the cached sample rate
+        length = math.ceil(song.size(-1) * sample_rate / song_sample_rate)
+
+        parts = []
+        position = 0
+        for segment in match.segments:
+            alignment = self._align_segment(segment, mix) if mix is not None else None
+            if alignment is None:
+                # separated with the next gap
+                continue
+            lag, gain = alignment
+            logger.info(
+                f"Reusing the vocals of frames [{segment.start}, {segment.stop})"
+            )
+            start = min(_frame_to_sample(segment.start, sample_rate), length)
+            stop = min(_frame_to_sample(segment.stop, sample_rate), length)
+            if start > position:
+                parts.append(self._separate(position, start, sample_rate))
+            # start of the segment in the recording, to the sample
+            cached_start = _frame_to_sample(segment.start + segment.offset, sample_rate)
+            cached_start += round(lag * sample_rate / song_sample_rate)
+            part = _slice_samples(cached, cached_start, cached_start + stop - start)
+            parts.append(gain * part.to(song.device))
+            position = stop
+        if position < length:
+            parts.append(self._separate(position, length, sample_rate))
+
+        if len({part.size(0) for part in parts}) > 1:
+            parts = [part.mean(0, keepdim=True) for part in parts]
+        waveform = torch.cat(parts, dim=-1)
+        assert waveform.size(-1) == length
+        return waveform, sample_rate
+
+    def _align_segment(
+        self, segment: FingerprintSegment, mix: tuple[torch.Tensor, int]
+    ) -> tuple[int, float] | None:
+        """
+        Lag (in song samples) to add to the frame offset of a segment, and gain
+        from the recording to the song. None if the song does not correlate
+        with the recording over this segment.
+        """
+        assert self.song is not None
+        song, song_sample_rate = self.song
+        recording, recording_sample_rate = mix
+        start = _frame_to_sample(segment.start, song_sample_rate)
+        stop = min(_frame_to_sample(segment.stop, song_sample_rate), song.size(-1))
+        # the middle of the segment, away from its uncertain bounds
+        length = min(round(ALIGNMENT_LENGTH * song_sample_rate), stop - start)
+        start = (start + stop - length) // 2
+        waveform = song[..., start : start + length].mean(0).cpu()
+
+        # the frame offset is off by up to a frame, and peaks by another one
+        max_lag = _frame_to_sample(2, song_sample_rate)
+        reference_start = (
+            start + _frame_to_sample(segment.offset, song_sample_rate) - max_lag
+        )
+        reference_stop = reference_start + length + 2 * max_lag
+        if recording_sample_rate == song_sample_rate:
+            reference = _slice_samples(recording, reference_start, reference_stop)
+        else:
+            # resample a slice with a margin for the filter
+            margin = 64
+            scale = recording_sample_rate / song_sample_rate
+            first = math.floor(reference_start * scale) - margin
+            last = math.ceil(reference_stop * scale) + margin
+            reference = _slice_samples(recording, first, last)
+            reference = self.resampler(
+                reference, recording_sample_rate, song_sample_rate
+            )
+            skip = reference_start - round(first / scale)
+            reference = _slice_samples(reference, skip, skip + length + 2 * max_lag)
+
+        lag, gain, correlation = align_waveforms(waveform, reference, max_lag)
+        # silent audio correlates with nothing (nan)
+        if not correlation >= MIN_CORRELATION:
+            logger.info(
+                f"Frames [{segment.start}, {segment.stop}) do not correlate with "
+                f"the recording ({correlation:.2f}), separating them"
+            )
+            return None
+        return lag, gain
+
+    def _separate(self, start: int, stop: int, sample_rate: int):
+        """
+        Vocals of the samples [start, stop) of the song, at `sample_rate`,
+        separated from these samples only. Short ranges are widened before the
+        separator and trimmed after it.
+        """
+        assert self.song is not None and self.separator is not None
+        song, song_sample_rate = self.song
+        part_start = round(start * song_sample_rate / sample_rate)
+        part_stop = round(stop * song_sample_rate / sample_rate)
+        min_len = round(MIN_SEPARATION_LENGTH * song_sample_rate)
+        widened_start = max(0, min(part_start, part_stop - min_len))
+        widened_stop = min(song.size(-1), max(part_stop, widened_start + min_len))
+        vocals, vocals_sample_rate = self.separator(
+            song[..., widened_start:widened_stop], song_sample_rate, self.resampler
+        )
+        vocals = self.resampler(vocals, vocals_sample_rate, sample_rate)
+        extra = round((part_start - widened_start) * sample_rate / song_sample_rate)
+        return _fit_samples(vocals[..., extra:].to(song.device), stop - start)
+
+    def _reuse_emission(self, match: FingerprintMatch):
+        """
+        Emission of the matched recording over the matching segments, and
+        computed from the vocals elsewhere.
+        """
+        assert self.fingerprints is not None and self.vocals is not None
+        waveform, sample_rate = self.vocals
+        fa_sample_rate = int(fa_bundle.sample_rate)
+        stride = StreamingEmission.FRAME_STRIDE
+        context = StreamingEmission.FRAME_CONTEXT
+        # number of frames of the emission of the whole vocals
+        length = math.ceil(waveform.size(-1) * fa_sample_rate / sample_rate)
+        nb_frames = (length - context) // stride
+
+        cached = self.fingerprints.load_emission(match)
+        parts = []
+        position = 0
+        for segment in match.segments:
+            start, stop = min(segment.start, nb_frames), min(segment.stop, nb_frames)
+            if start > position:
+                parts.append(self._compute_frames(position, start))
+            # the fingerprint of the recording has a few more frames than its
+            # emission, the end of a segment can be missing
+            part = cached[:, start + segment.offset : stop + segment.offset]
+            if part.size(1) > 0:
+                parts.append(_fit_frames(part, stop - start))
+            elif stop > start:
+                parts.append(self._compute_frames(start, stop))
+            position = stop
+        if position < nb_frames:
+            parts.append(self._compute_frames(position, nb_frames))
+        emission = torch.cat(parts, dim=1)
+        assert emission.size(1) == nb_frames
+        return emission
+
+    def _compute_frames(self, start: int, stop: int):
+        """
+        Emission frames [start, stop) of the vocals, computed from these frames
+        only. Short ranges are widened before the model and trimmed after it.
+        """
+        assert self.vocals is not None
+        waveform, sample_rate = self.vocals
+        fa_sample_rate = int(fa_bundle.sample_rate)
+        # the last frame needs some context after it
+        context = math.ceil(
+            StreamingEmission.FRAME_CONTEXT * sample_rate / fa_sample_rate
+        )
+        first = max(0, min(start, stop - MIN_EMISSION_FRAMES))
+        part_start = _frame_to_sample(first, sample_rate)
+        part_stop = _frame_to_sample(stop, sample_rate) + context
+        part = waveform[..., part_start:part_stop]
+        emission = compute_emission(part, sample_rate, self.resampler).cpu()
+        return _fit_frames(emission[:, start - first :], stop - start)
+
+    def _remember(self):
+        if (
+            self.fingerprints is None
+            or self.fingerprint is None
+            or self.vocals is None
+            or self.forced_alignment is None
+        ):
+            return
+        if self.reuse is not None and self.reuse.covers(self.fingerprint):
+            return
+        assert self.song is not None
+        emission, _ = self.forced_alignment
+        self.fingerprints.add(
+            self.fingerprint,
+            type(self.separator).__name__,
+            self.song,
+            self.vocals,
+            emission,
+        )
+
+
+def _frame_to_sample(frame: int, sample_rate: int):
+    return round(frame * sample_rate / FRAME_RATE)
+
+
+def _slice_samples(waveform: torch.Tensor, start: int, stop: int):
+    """
+    Samples [start, stop) of a waveform, padded with silence outside of it.
+    """
+    part = waveform[..., max(start, 0) : max(stop, 0)]
+    before = min(max(-start, 0), stop - start)
+    return F.pad(part, (before, stop - start - before - part.size(-1)))
+
+
+def _fit_samples(waveform: torch.Tensor, length: int):
+    """
+    Trim or pad (with silence) a waveform to `length` samples, to absorb the
+    rounding of resampled slices.
+    """
+    waveform = waveform[..., :length]
+    return F.pad(waveform, (0, length - waveform.size(-1)))
+
+
+def _fit_frames(emission: torch.Tensor, nb_frames: int):
+    """
+    Trim or pad (repeating the last frame) an emission to `nb_frames`, to
+    absorb the rounding of resampled slices.
+    """
+    emission = emission[:, :nb_frames]
+    missing = nb_frames - emission.size(1)
+    if missing > 0:
+        padding = emission[:, -1:].expand(-1, missing, -1)
+        emission = torch.cat((emission, padding), dim=1)
+    return emission
@@ -0,0 +1,99 @@
+import logging
+import math
+from dataclasses import dataclass, field
+
+import torch
+
+from yohane.audio import align_emission, compute_emission
+from yohane.resampling import Resampler, resample
+
+logger = logging.getLogger(__name__)
+
+
+class PreflightError(RuntimeError):
+    pass
+
+
+@dataclass
+class PreflightReport:
+    duration: float  # s
+    nb_tokens: int
+    score: float  # mean token probability along the alignment path
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def tokens_per_second(self):
+        return self.nb_tokens / self.duration if self.duration else math.inf
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __str__(self):
+        summary = (
+            f"{self.tokens_per_second:.1f} tokens/s over {self.duration:.0f}s, "
+            f"alignment score {self.score:.2f}"
+        )
+        return "; ".join([summary, *self.errors])
+
+
+def downsample_emission(emission: torch.Tensor, factor: int):
+    """
+    Merge every `factor` frames of a log-probability emission into one frame
+    holding their mean probability.
+    """
+    batch, nb_frames, nb_labels = emission.shape
+    nb_frames = nb_frames // factor
+    emission = emission[:, : nb_frames * factor]
+    emission = emission.reshape(batch, nb_frames, factor, nb_labels)
+    return emission.logsumexp(2) - math.log(factor)
+
+
+def preflight(
+    waveform: torch.Tensor,
+    sample_rate: int,
+    transcript: list[str],
+    tokens: list[list[int]] | None = None,
+    *,
+    max_tokens_per_second: float | None,
+    min_score: float | None,
+    downsampling: int = 2,
+    resampler: Resampler = resample,
+    emission: torch.Tensor | None = None,
+):
+    """
+    Coarse forced alignment of the transcript on the raw mix, to catch a wrong
+    lyrics file or song version before running the source separation.
+
+    This costs a full pass of the alignment model over the mix, about as much
+    as `compute_emission` on the vocals, unless `emission` (the emission of
+    the mix) is given. `downsampling` only shortens the alignment search.
+
+    The thresholds depend on the songs and lyrics style, there are no
+    defaults: a check is skipped when its threshold is None.
+    """
+    duration = waveform.size(-1) / sample_rate
+    if emission is None:
+        emission = compute_emission(waveform, sample_rate, resampler)
+    emission = downsample_emission(emission, downsampling)
+
+    try:
+        token_spans = align_emission(emission, transcript, tokens)
+    except RuntimeError as e:
+        # the transcript does not fit in the number of frames
+        nb_tokens = sum(map(len, tokens)) if tokens else len("".join(transcript))
+        return PreflightReport(duration, nb_tokens, 0.0, [f"alignment failed: {e}"])
+
+    spans = [span for word_spans in token_spans for span in word_spans]
+    score = sum(span.score for span in spans) / len(spans) if spans else 0.0
+    report = PreflightReport(duration, len(spans), score)
+    if (
+        max_tokens_per_second is not None
+        and report.tokens_per_second > max_tokens_per_second
+    ):
+        report.errors.append(
+            f"more than {max_tokens_per_second} tokens/s, is the song too short?"
+        )
+    if min_score is not None and report.score < min_score:
+        report.errors.append(f"alignment score below {min_score}, wrong lyrics?")
+    return report
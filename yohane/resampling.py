@@ -0,0 +1,79 @@
+import weakref
+from functools import lru_cache
+
+import torch
+from torchaudio.transforms import Resample
+
+
+@lru_cache(maxsize=16)
+def get_resample_kernel(
+    orig_freq: int, new_freq: int, dtype: torch.dtype, device: torch.device
+) -> Resample:
+    """
+    Resampling transform with a precomputed filter kernel, shared by every
+    caller with the same parameters.
+    """
+    return Resample(orig_freq, new_freq, dtype=dtype).to(device)
+
+
+class Resampler:
+    """
+    Resamples waveforms with cached kernels.
+
+    With `memoize`, the result for a given source tensor is kept for the
+    lifetime of the instance, so asking again for the same waveform at the
+    same rate is free.
+    """
+
+    def __init__(self, memoize: bool = True):
+        self.memoize = memoize
+        self._results: dict[
+            tuple[int, int, int], tuple[weakref.ref[torch.Tensor], torch.Tensor]
+        ] = {}
+
+    def __call__(
+        self, waveform: torch.Tensor, orig_freq: int, new_freq: int
+    ) -> torch.Tensor:
+        if orig_freq == new_freq:
+            return waveform
+
+        if (result := self.cached(waveform, orig_freq, new_freq)) is not None:
+            return result
+
+        kernel = get_resample_kernel(
+            orig_freq, new_freq, waveform.dtype, waveform.device
+        )
+        result = kernel(waveform)
+
+        if self.memoize:
+            self._prune()
+            key = (id(waveform), orig_freq, new_freq)
+            self._results[key] = weakref.ref(waveform), result
+        return result
+
+    def cached(
+        self, waveform: torch.Tensor, orig_freq: int, new_freq: int
+    ) -> torch.Tensor | None:
+        """
+        The memoized resampling of `waveform`, if it has already been computed.
+        """
+        if orig_freq == new_freq:
+            return waveform
+        cached = self._results.get((id(waveform), orig_freq, new_freq))
+        if cached is not None:
+            source, result = cached
+            if source() is waveform:
+                return result
+        return None
+
+    def clear(self):
+        self._results.clear()
+
+    def _prune(self):
+        for key, (source, _) in list(self._results.items()):
+            if source() is None:
+                del self._results[key]
+
+
+# stateless default for callers outside of a pipeline run
+resample = Resampler(memoize=False)
@@ -0,0 +1,210 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from itertools import pairwise
+from multiprocessing.queues import Queue
+from multiprocessing.synchronize import Barrier
+from typing import Literal
+
+import torch
+
+from yohane.audio import fa_bundle, get_fa_model
+
+logger = logging.getLogger(__name__)
+
+Stage = Literal["separation", "emission", "alignment"]
+
+# synthetic clip the alignment model is benchmarked on
+BENCHMARK_CLIP = 10.0  # s
+BENCHMARK_TIMEOUT = 600.0  # s, for all the workers to load the model
+
+# torch thread settings are process-wide: stages running concurrently in
+# several threads share them, and the value from before the first of them
+# is restored when the last one exits
+_threads_lock = threading.Lock()
+_active_stages = 0
+_saved_threads = 0
+
+
+@dataclass
+class StageThreads:
+    intra_op: int | None = None  # None: torch default
+
+
+@dataclass
+class ResourceConfig:
+    """
+    CPU resources given to a pipeline run.
+
+    Intra-op thread counts are set around each stage. The inter-op thread
+    count can only be set once per process, before any parallel work, so it
+    is applied by `apply`, like `intra_op` which is the default for the
+    stages without their own count. `cpus` pins the process to a core set.
+
+    When several pipelines run concurrently in one process, the thread count
+    is shared: set `intra_op` only.
+    """
+
+    separation: StageThreads = field(default_factory=StageThreads)
+    emission: StageThreads = field(default_factory=StageThreads)
+    alignment: StageThreads = field(default_factory=StageThreads)
+    intra_op: int | None = None
+    inter_op: int | None = None
+    cpus: list[int] | None = None
+
+    def apply(self):
+        if self.cpus is not None:
+            if hasattr(os, "sched_setaffinity"):
+                logger.info(f"Pinning process {os.getpid()} to cpus {self.cpus}")
+                os.sched_setaffinity(0, self.cpus)
+            else:
+                logger.warning("CPU pinning is not supported on this platform")
+        if self.intra_op is not None:
+            torch.set_num_threads(self.intra_op)
+        if self.inter_op is not None:
+            try:
+                torch.set_num_interop_threads(self.inter_op)
+            except RuntimeError:
+                logger.warning(
+                    "Inter-op threads can only be set before any parallel work, "
+                    f"keeping {torch.get_num_interop_threads()}"
+                )
+
+    @contextmanager
+    def stage(self, name: Stage):
+        global _active_stages, _saved_threads
+        threads = getattr(self, name).intra_op
+        if threads is None:
+            yield
+            return
+        with _threads_lock:
+            if _active_stages == 0:
+                _saved_threads = torch.get_num_threads()
+            _active_stages += 1
+            torch.set_num_threads(threads)
+        try:
+            yield
+        finally:
+            with _threads_lock:
+                _active_stages -= 1
+                if _active_stages == 0:
+                    torch.set_num_threads(_saved_threads)
+
+    def split(self, workers: int) -> list["ResourceConfig"]:
+        """
+        One config per worker, each pinned to a disjoint set of the cpus
+        available to this process. The thread counts of each worker are capped
+        at its number of cpus, which is also its default intra-op count.
+        """
+        cpus = self.cpus if self.cpus is not None else available_cpus()
+        return [self._pinned(cpu_set) for cpu_set in share_cpus(cpus, workers)]
+
+    def _pinned(self, cpus: list[int]):
+        def cap(threads: int | None):
+            return len(cpus) if threads is None else min(threads, len(cpus))
+
+        def cap_stage(stage: StageThreads):
+            if stage.intra_op is None:
+                return stage
+            return StageThreads(cap(stage.intra_op))
+
+        return replace(
+            self,
+            separation=cap_stage(self.separation),
+            emission=cap_stage(self.emission),
+            alignment=cap_stage(self.alignment),
+            intra_op=cap(self.intra_op),
+            inter_op=self.inter_op and min(self.inter_op, len(cpus)),
+            cpus=cpus,
+        )
+
+
+def available_cpus() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def share_cpus(cpus: list[int], workers: int) -> list[list[int]]:
+    """
+    Split `cpus` into `workers` disjoint sets using every cpu, whose sizes
+    differ by at most one.
+    """
+    if not 0 < workers <= len(cpus):
+        raise ValueError(f"Cannot split {len(cpus)} cpus between {workers=}")
+    size, extra = divmod(len(cpus), workers)
+    bounds = [i * size + min(i, extra) for i in range(workers + 1)]
+    return [cpus[start:stop] for start, stop in pairwise(bounds)]
+
+
+def candidate_splits(cpus: int) -> list[int]:
+    """
+    Numbers of workers worth comparing: one per distinct number of threads
+    per worker.
+    """
+    return sorted({cpus // threads for threads in range(1, cpus + 1)})
+
+
+def recommend_split(results: dict[int, float], tolerance: float = 0.05) -> int:
+    """
+    Number of workers to use, from the throughput measured for each number of
+    workers by `benchmark_split`: the fewest workers, which use the least
+    memory, within `tolerance` of the best throughput.
+    """
+    best = max(results.values())
+    return min(
+        workers
+        for workers, throughput in results.items()
+        if throughput >= best * (1 - tolerance)
+    )
+
+
+def _benchmark_worker(
+    cpus: list[int],
+    duration: float,
+    barrier: "Barrier",
+    results: "Queue[float]",
+):
+    ResourceConfig(intra_op=len(cpus), cpus=cpus).apply()
+    model = get_fa_model()
+    generator = torch.Generator().manual_seed(0)
+    clip_len = int(BENCHMARK_CLIP * fa_bundle.sample_rate)
+    clip = 0.1 * torch.randn(1, clip_len, generator=generator)
+    processed = 0.0
+    with torch.inference_mode():
+        model(clip)  # warmup
+        # measure while every worker is running
+        barrier.wait(timeout=BENCHMARK_TIMEOUT)
+        start = time.monotonic()
+        while (elapsed := time.monotonic() - start) < duration:
+            model(clip)
+            processed += BENCHMARK_CLIP
+    results.put(processed / elapsed)
+
+
+def benchmark_split(workers: int, duration: float = 5.0) -> float:
+    """
+    Aggregated throughput of the alignment model, in seconds of audio per
+    second, of `workers` processes pinned to disjoint shares of the cpus.
+    """
+    get_fa_model()  # download the weights once, before the workers load them
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=_benchmark_worker, args=(cpu_set, duration, barrier, results)
+        )
+        for cpu_set in share_cpus(available_cpus(), workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    if any(process.exitcode != 0 for process in processes):
+        raise RuntimeError(f"A benchmark worker failed with {workers=}")
+    return sum(results.get() for _ in processes)
@@ -11,7 +11,7 @@ from yohane.lyrics import RichText, Syllable, normalize_uroman
 from yohane.utils import get_identifier
 
 
-@dataclass
+@dataclass(slots=True)
 class TimedSyllable:
     value: Syllable
     start_s: float  # s
@@ -0,0 +1,134 @@
+import logging
+import multiprocessing
+import os
+from collections.abc import Callable
+from multiprocessing.pool import AsyncResult
+from multiprocessing.sharedctypes import SynchronizedArray
+from typing import Concatenate, ParamSpec, TypeVar
+
+from yohane.audio import Separator, get_fa_model
+from yohane.fingerprint import FingerprintIndex
+from yohane.pipeline import Yohane
+from yohane.resources import ResourceConfig
+
+logger = logging.getLogger(__name__)
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+_separator: Separator | None = None
+_low_memory = False
+_resources: ResourceConfig | None = None
+_fingerprints: FingerprintIndex | None = None
+
+
+def _is_alive(pid: int):
+    if pid == 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _claim_slot(slots: "SynchronizedArray[int]"):
+    """
+    Index of a config slot not held by a live worker, now held by this one.
+    """
+    # the pool reaps dead workers before starting their replacements, so the
+    # slot of a dead worker is free by the time its replacement starts
+    with slots.get_lock():
+        for idx, pid in enumerate(slots):
+            if not _is_alive(pid):
+                slots[idx] = os.getpid()
+                return idx
+    logger.warning("No free worker slot, sharing the first one")
+    return 0
+
+
+def _init_worker(
+    separator: Separator | None,
+    low_memory: bool,
+    configs: list[ResourceConfig | None],
+    slots: "SynchronizedArray[int]",
+    fingerprints: FingerprintIndex | None,
+):
+    global _separator, _low_memory, _resources, _fingerprints
+    _separator = separator
+    _low_memory = low_memory
+    _fingerprints = fingerprints
+    _resources = configs[_claim_slot(slots)] if len(configs) > 1 else configs[0]
+    if _resources is not None:
+        _resources.apply()
+
+
+def _run(func: Callable[..., T], args: tuple, kwargs: dict) -> T:
+    yohane = Yohane(_separator, _low_memory, _resources, _fingerprints)
+    return func(yohane, *args, **kwargs)
+
+
+class YohanePool:
+    """
+    Pre-fork pool of pipeline workers.
+
+    The models are loaded once in the parent and their weights are moved to
+    shared memory before forking, so each worker only allocates its own
+    activations. Requires the "fork" start method (Linux/macOS).
+
+    With `pin`, each worker is pinned to its own share of the cpus.
+    """
+
+    def __init__(
+        self,
+        separator: Separator | None,
+        processes: int,
+        low_memory: bool = False,
+        resources: ResourceConfig | None = None,
+        pin: bool = False,
+        fingerprints: FingerprintIndex | None = None,
+    ):
+        logger.info("Loading models in shared memory")
+        if separator is not None:
+            separator.share_memory()
+        get_fa_model().share_memory()
+
+        ctx = multiprocessing.get_context("fork")
+        # every worker holds one config slot, its replacement takes it over
+        configs: list[ResourceConfig | None]
+        if pin:
+            configs = list((resources or ResourceConfig()).split(processes))
+        else:
+            configs = [resources]
+        slots = ctx.Array("i", len(configs))
+        self._pool = ctx.Pool(
+            processes,
+            initializer=_init_worker,
+            initargs=(separator, low_memory, configs, slots, fingerprints),
+        )
+
+    def submit(
+        self,
+        func: Callable[Concatenate[Yohane, P], T],
+        *args: P.args,
+        **kwargs: P.kwargs,
+    ) -> AsyncResult[T]:
+        """
+        Run `func` in a worker with a fresh `Yohane` instance as first argument.
+        `func` must be picklable (i.e. defined at module level).
+        """
+        return self._pool.apply_async(_run, (func, args, kwargs))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._pool.terminate()
+        self.close()